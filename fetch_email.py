@@ -1,8 +1,9 @@
 """Fetch latest Excel attachments from Gmail via IMAP."""
+import binascii
 import imaplib
-import email
 import os
-from email.header import decode_header
+from email import policy
+from email.parser import BytesParser
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,11 +17,27 @@ DOWNLOAD_DIR = os.path.join(os.path.dirname(__file__), "downloads")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 
-def decode_subject(msg):
-    subject, encoding = decode_header(msg["Subject"])[0]
-    if isinstance(subject, bytes):
-        subject = subject.decode(encoding or "utf-8")
-    return subject
+# policy.default decodes RFC 2047/2231 headers and filenames itself
+PARSER = BytesParser(policy=policy.default)
+
+CHUNK_LINES = 1024  # base64 lines decoded per write (~76 KiB of input)
+
+
+def write_payload(part, f):
+    """Write the decoded payload of part to f, base64 a block of lines at a time."""
+    if part.get("Content-Transfer-Encoding", "").strip().lower() != "base64":
+        f.write(part.get_payload(decode=True) or b"")
+        return
+
+    lines = part.get_payload().splitlines()
+    try:
+        for i in range(0, len(lines), CHUNK_LINES):
+            f.write(binascii.a2b_base64("".join(lines[i:i + CHUNK_LINES])))
+    except binascii.Error:
+        # Odd line lengths split a base64 quantum: redo it as one lenient decode
+        f.seek(0)
+        f.truncate()
+        f.write(part.get_payload(decode=True))
 
 
 def fetch_latest_attachments(max_emails=5):
@@ -44,33 +61,35 @@ def fetch_latest_attachments(max_emails=5):
     latest_ids = email_ids[-max_emails:]
     downloaded = []
 
-    for eid in reversed(latest_ids):
-        status, data = mail.fetch(eid, "(RFC822)")
-        if status != "OK":
-            continue
+    # Single pipelined FETCH; BODY.PEEK[] doesn't mark messages as read
+    status, data = mail.fetch(b",".join(latest_ids), "(BODY.PEEK[])")
+    if status != "OK":
+        print("FETCH failed")
+        mail.logout()
+        return []
 
-        msg = email.message_from_bytes(data[0][1])
-        subject = decode_subject(msg)
+    # Message tuples are interleaved with closing b')' entries
+    bodies = [item[1] for item in data if isinstance(item, tuple)]
+
+    for raw in reversed(bodies):
+        msg = PARSER.parsebytes(raw)
+        subject = msg["Subject"]
         date = msg["Date"]
         print(f"\n--- Email: {subject} ({date}) ---")
 
-        for part in msg.walk():
+        # Only attachment parts; body text/html parts are skipped
+        for part in msg.iter_attachments():
             content_type = part.get_content_type()
-            filename = part.get_filename()
-
-            if filename:
-                # Decode filename if needed
-                decoded_name, enc = decode_header(filename)[0]
-                if isinstance(decoded_name, bytes):
-                    decoded_name = decoded_name.decode(enc or "utf-8")
+            decoded_name = part.get_filename()
 
+            if decoded_name:
                 print(f"  Attachment: {decoded_name} ({content_type})")
 
                 # Save Excel files
-                if decoded_name.endswith((".xlsx", ".xls", ".csv")):
+                if decoded_name.lower().endswith((".xlsx", ".xls", ".csv")):
                     filepath = os.path.join(DOWNLOAD_DIR, decoded_name)
                     with open(filepath, "wb") as f:
-                        f.write(part.get_payload(decode=True))
+                        write_payload(part, f)
                     print(f"  -> Saved to {filepath}")
                     downloaded.append(filepath)
 
@@ -86,7 +105,7 @@ if __name__ == "__main__":
         try:
             import openpyxl
             for f in files:
-                if f.endswith(".xlsx"):
+                if f.lower().endswith(".xlsx"):
                     wb = openpyxl.load_workbook(f, read_only=True)
                     for sheet_name in wb.sheetnames:
                         ws = wb[sheet_name]
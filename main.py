@@ -4,20 +4,29 @@ Sources: Excel from email (no-reply@business.auto.ru) + POST /comeback API.
 Offers are merged by offer_id, deduplicated, and sent as a single digest.
 """
 import imaplib
-import email
+import functools
+import hashlib
+import io
 import os
+import re
 import json
-import urllib.request
+import tempfile
+import http.client
+import multiprocessing
+import threading
 import urllib.error
+import urllib.parse
 import time
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from email.header import decode_header
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Optional
 
 from dotenv import load_dotenv
-import openpyxl
 
 load_dotenv()
 
@@ -31,11 +40,24 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
 VERTIS_SESSION_ID = os.getenv("VERTIS_SESSION_ID")
 COMEBACK_API_URL = "https://apiauto.ru/1.0/comeback"
+API_MAX_WORKERS = 4  # concurrent page requests after page 1
 
+# Large batches of attachments are parsed in worker processes (openpyxl is
+# pure Python); below PARSE_POOL_MIN_BYTES spawning workers costs more than it saves
+PARSE_MAX_WORKERS = min(4, os.cpu_count() or 1)
+PARSE_POOL_MIN_BYTES = 1_000_000
+
+# Attachments are parsed straight from memory; KEEP_DOWNLOADS=1/true/yes also saves them
+KEEP_DOWNLOADS = os.getenv("KEEP_DOWNLOADS", "").strip().lower() in ("1", "true", "yes")
 DOWNLOAD_DIR = os.path.join(os.path.dirname(__file__), "downloads")
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+if KEEP_DOWNLOADS:
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+# Attachment types worth downloading (matched on the lowercased filename)
+EXCEL_EXTENSIONS = (".xlsx", ".xls", ".csv")
 
 STATE_FILE = os.path.join(os.path.dirname(__file__), "processed_ids.json")
+STATE_MAX_IDS = 10_000  # per id list in STATE_FILE
 
 
 # ── Data model ────────────────────────────────────────────────────
@@ -56,6 +78,11 @@ class ComebackOffer:
 
 # ── State management (auto-migrating) ────────────────────────────
 
+# Id lists are held as insertion-ordered dicts (ordered sets) at runtime:
+# O(1) membership and in-place updates, oldest-first order for the size cap
+ID_KEYS = ("email_message_ids", "api_offer_ids")
+
+
 def load_state():
     """Load state dict. Auto-migrate from old list format."""
     try:
@@ -67,73 +94,98 @@ def load_state():
     # Old format: plain list of email message IDs
     if isinstance(data, list):
         print("[State] Migrating from list → dict format")
-        return {
-            "email_message_ids": data,
-            "api_offer_ids": [],
-            "api_last_fetch": None,
-        }
+        data = {"email_message_ids": data}
+
+    if not isinstance(data, dict):
+        data = {}
 
-    if isinstance(data, dict):
-        # Ensure all keys exist
-        data.setdefault("email_message_ids", [])
-        data.setdefault("api_offer_ids", [])
-        data.setdefault("api_last_fetch", None)
-        return data
+    # Ensure all keys exist
+    data.setdefault("email_message_ids", [])
+    data.setdefault("api_offer_ids", [])
+    data.setdefault("api_last_fetch", None)
+    # Pre-UID state: last_uid=0 means no watermark yet (Message-IDs still dedup)
+    data.setdefault("last_uid", 0)
+    data.setdefault("uid_validity", None)
+    for key in ID_KEYS:
+        data[key] = dict.fromkeys(data[key])
+    return data
 
-    return {"email_message_ids": [], "api_offer_ids": [], "api_last_fetch": None}
+
+def remember_ids(ids, new_ids):
+    """Add unseen ids to an ordered id set in place, in a stable order."""
+    ids.update(dict.fromkeys(sorted(new_ids)))
 
 
 def save_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, ensure_ascii=False)
+    # Keep only the newest STATE_MAX_IDS per list: dedup only has to cover
+    # ids that can still come back, not every id ever sent
+    data = dict(state)
+    for key in ID_KEYS:
+        data[key] = list(state[key])[-STATE_MAX_IDS:]
+    # Write-then-rename: a crash mid-write can't leave a truncated state file.
+    # Unique temp name: the timer and the backup cron may save at the same time
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(STATE_FILE), prefix=".state-", suffix=".tmp", delete=False
+    ) as f:
+        tmp_path = f.name
+        try:
+            json.dump(data, f, ensure_ascii=False)
+        except BaseException:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+    os.replace(tmp_path, STATE_FILE)
 
 
 # ── Helpers (unchanged) ──────────────────────────────────────────
 
-def decode_header_value(value):
-    if not value:
-        return ""
-    parts = decode_header(value)
-    result = []
-    for part, encoding in parts:
-        if isinstance(part, bytes):
-            result.append(part.decode(encoding or "utf-8", errors="replace"))
-        else:
-            result.append(part)
-    return " ".join(result)
+# First quoted argument of a =HYPERLINK(...) formula (closing quote optional)
+_HYPERLINK_RE = re.compile(r'=HYPERLINK[^"]*"([^"]*)')
 
 
 def extract_url(val):
     """Extract URL from =HYPERLINK(...) formula."""
-    if isinstance(val, str) and val.startswith("=HYPERLINK"):
-        parts = val.split('"')
-        if len(parts) >= 2:
-            return parts[1]
-    return val if isinstance(val, str) else ""
+    if not isinstance(val, str):
+        return ""
+    m = _HYPERLINK_RE.match(val)
+    return m.group(1) if m else val
+
+
+# Last path segment of an offer URL: "<digits>-<hex>", trailing slash optional
+_OFFER_ID_RE = re.compile(r"(?:^|/)(\d+-[0-9a-f]+)/*$")
 
 
 def extract_offer_id(url):
     """Extract offer ID from auto.ru URL like '1131420679-5346d8a6'."""
     if not url:
         return ""
-    parts = url.rstrip("/").split("/")
-    if parts:
-        last = parts[-1]
-        if "-" in last and any(c.isdigit() for c in last):
-            return last
-    return ""
+    m = _OFFER_ID_RE.search(url)
+    return m.group(1) if m else ""
 
 
+@functools.lru_cache(maxsize=4096)
 def normalize_offer_id(oid):
     """Normalize offer_id for matching: lowercase, strip, no trailing slash."""
     return oid.lower().strip().rstrip("/")
 
 
+@functools.lru_cache(maxsize=1024)
+def normalize_model(value):
+    """'land cruiser' → 'LAND_CRUISER'. Cached: reports repeat a few models."""
+    return str(value or "").upper().replace(" ", "_")
+
+
+DESKTOP_PREFIX = "https://auto.ru/"
+MOBILE_PREFIX = "https://m.auto.ru/"
+
+
 def make_mobile_link(url):
     """Convert auto.ru URL to m.auto.ru."""
     if not url:
         return ""
-    return url.replace("https://auto.ru/", "https://m.auto.ru/")
+    if url.startswith(DESKTOP_PREFIX):
+        return MOBILE_PREFIX + url[len(DESKTOP_PREFIX):]
+    return url
 
 
 SALON_SHORT = {
@@ -150,182 +202,484 @@ SALON_SHORT = {
 }
 
 
+def _key_matcher(keys):
+    """Compile keys into one regex that finds every (overlapping) occurrence."""
+    # Lookahead: finditer reports a match at each position, not just the
+    # leftmost non-overlapping ones; alternation tries keys in dict order
+    return re.compile("(?=(%s))" % "|".join(map(re.escape, keys)))
+
+
+def _first_key(matcher, mapping, text):
+    """Key of mapping that occurs in text, earliest in dict order, or None.
+
+    Same priority as `for key in mapping: if key in text` (the dict order,
+    not the position in text), with a single regex scan of the text.
+    """
+    found = {m.group(1) for m in matcher.finditer(text)}
+    return next((key for key in mapping if key in found), None)
+
+
+# All salon keys in one pattern: a single C-level scan per name
+# instead of a Python substring search per key
+_SALON_RE = _key_matcher(SALON_SHORT)
+
+
+@functools.lru_cache(maxsize=1024)
 def short_salon(name):
-    """Convert salon name to short code."""
+    """Convert salon name to short code. Cached: a report has ~10 distinct salons."""
     if not name:
         return "???"
-    lower = name.lower().strip()
-    for key, code in SALON_SHORT.items():
-        if key in lower:
-            return code
+    key = _first_key(_SALON_RE, SALON_SHORT, name.lower().strip())
+    if key:
+        return SALON_SHORT[key]
     return name.split()[0][:3].upper() if name else "???"
 
 
-def col_index(headers, *names):
-    """Find column index by name (case-insensitive)."""
-    h_lower = {str(h).lower(): i for i, h in enumerate(headers) if h}
-    for name in names:
-        if name in h_lower:
-            return h_lower[name]
-    return None
+def header_map(headers):
+    """Map lowercased header → column index. Build once per sheet, then .get(name)."""
+    return {str(h).lower(): i for i, h in enumerate(headers) if h}
+
+
+# ── Gmail ────────────────────────────────────────────────────────
+
+_FETCH_TOKEN_RE = re.compile(rb'[()]|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+_FETCH_UNESCAPE_RE = re.compile(rb"\\(.)")
+
+
+def _fetch_tokens(data):
+    """Flatten an imaplib FETCH response into tokens; literals come as 1-tuples.
+
+    imaplib hands back text segments with every literal split out as a
+    (b'... {size}', literal) tuple.
+    """
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            yield from _FETCH_TOKEN_RE.findall(head[:head.rindex(b"{")])
+            yield (literal,)
+        elif item:
+            yield from _FETCH_TOKEN_RE.findall(item)
+
+
+def _parse_fetch(data):
+    """Parse a UID FETCH response into {uid: {b"ITEM": value}}.
+
+    Parenthesised lists become nested Python lists, so BODYSTRUCTURE comes
+    back as a tree and BODY[...] items as raw bytes.
+    """
+    stack = [[]]
+    for tok in _fetch_tokens(data):
+        if isinstance(tok, tuple):
+            stack[-1].append(tok[0])
+        elif tok == b"(":
+            stack.append([])
+        elif tok == b")":
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        elif tok.startswith(b'"'):
+            stack[-1].append(_FETCH_UNESCAPE_RE.sub(rb"\1", tok[1:-1]))
+        elif tok.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(tok)
+
+    # Top level alternates: message number, (ITEM value ITEM value ...)
+    fetched = {}
+    for entry in stack[0]:
+        if not isinstance(entry, list):
+            continue
+        items = {k.upper(): v for k, v in zip(entry[::2], entry[1::2]) if isinstance(k, bytes)}
+        if b"UID" in items:
+            fetched.setdefault(int(items.pop(b"UID")), {}).update(items)
+    return fetched
 
 
-def get(row, idx):
-    """Safe get from row by index."""
-    if idx is not None and idx < len(row):
-        return row[idx]
+_HEADER_PARSER = BytesHeaderParser(policy=policy.default)
+
+
+def _imap_str(value):
+    return value.decode("utf-8", errors="replace") if isinstance(value, bytes) else ""
+
+
+def _with_params(value, params):
+    """Render an IMAP (key value ...) param list back into header syntax."""
+    pairs = zip(params[::2], params[1::2]) if isinstance(params, list) else ()
+    rendered = [_imap_str(value)]
+    for key, val in pairs:
+        val = _imap_str(val).replace("\\", "\\\\").replace('"', '\\"')
+        rendered.append(f'{_imap_str(key)}="{val}"')
+    return "; ".join(rendered)
+
+
+def _iter_parts(structure, number=""):
+    """Yield (part_number, leaf) for every non-multipart BODYSTRUCTURE node."""
+    if isinstance(structure[0], list):
+        for i, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break  # child parts end where subtype/extension data begins
+            yield from _iter_parts(child, f"{number}.{i}" if number else str(i))
+    else:
+        yield number or "1", structure
+
+
+def _disposition(leaf):
+    """Body disposition list of a BODYSTRUCTURE leaf, or None."""
+    maintype = _imap_str(leaf[0]).lower()
+    subtype = _imap_str(leaf[1]).lower()
+    # Disposition follows the type-specific fields (RFC 3501 §7.4.2)
+    if maintype == "text":
+        disp_idx = 9
+    elif (maintype, subtype) == ("message", "rfc822"):
+        disp_idx = 11
+    else:
+        disp_idx = 8
+    disposition = leaf[disp_idx] if len(leaf) > disp_idx else None
+    if isinstance(disposition, list) and disposition and disposition[0]:
+        return disposition
     return None
 
 
-# ── Gmail ────────────────────────────────────────────────────────
+def _has_filename(leaf):
+    """Cheap pre-check on raw params: does the part carry a (file)name at all?"""
+    keys = leaf[2][::2] if isinstance(leaf[2], list) else []
+    disposition = _disposition(leaf)
+    if disposition and len(disposition) > 1 and isinstance(disposition[1], list):
+        keys += disposition[1][::2]
+    return any(isinstance(k, bytes) and k.lower().startswith((b"name", b"filename")) for k in keys)
+
+
+def _part_headers(leaf):
+    """Header-only message for a BODYSTRUCTURE leaf (for get_filename/decoding)."""
+    # policy.default: get_filename() already decodes RFC 2047/2231 names
+    part = EmailMessage()
+    content_type = f"{_imap_str(leaf[0]).lower()}/{_imap_str(leaf[1]).lower()}"
+    part["Content-Type"] = _with_params(content_type, leaf[2])
+    part["Content-Transfer-Encoding"] = _imap_str(leaf[5]) or "7bit"
+    disposition = _disposition(leaf)
+    if disposition:
+        part["Content-Disposition"] = _with_params(disposition[0], disposition[1] if len(disposition) > 1 else None)
+    return part
+
 
 def fetch_today_emails(state):
-    """Fetch today's emails, return (results, new_message_ids)."""
-    processed = set(state.get("email_message_ids", []))
-    print(f"[Gmail] Connecting as {GMAIL_USER}... ({len(processed)} already processed)")
+    """Fetch today's new emails, return (results, new_message_ids, cursor).
+
+    Only UIDs above state["last_uid"] are searched, so already-processed
+    messages are never downloaded. Headers and BODYSTRUCTURE come first;
+    only the Excel parts themselves are then fetched, and results carry
+    them as (subject, [(filename, payload_bytes)]). cursor holds the
+    updated last_uid / uid_validity for the caller to store once the
+    digest is delivered.
+    """
+    last_uid = state.get("last_uid") or 0
+    print(f"[Gmail] Connecting as {GMAIL_USER}... (last UID {last_uid})")
     mail = imaplib.IMAP4_SSL(IMAP_SERVER)
     mail.login(GMAIL_USER, GMAIL_APP_PASSWORD)
     mail.select("inbox")
 
+    # UIDs are only comparable within one UIDVALIDITY epoch
+    _, validity = mail.response("UIDVALIDITY")
+    uid_validity = int(validity[0]) if validity and validity[0] else None
+    if uid_validity != state.get("uid_validity"):
+        if last_uid:
+            print("[Gmail] UIDVALIDITY changed — rescanning today's emails")
+        last_uid = 0
+    cursor = {"last_uid": last_uid, "uid_validity": uid_validity}
+
+    # Message-ID dedup on top of the watermark: an incomplete download rolls
+    # the cursor back below messages that were already sent this run
+    processed = state["email_message_ids"]
+
     today = datetime.now().strftime("%d-%b-%Y")
-    status, messages = mail.search(
-        None, f'(FROM "{SENDER_FILTER}" SINCE {today})'
+    status, messages = mail.uid(
+        "SEARCH", None, f'(FROM "{SENDER_FILTER}" SINCE {today} UID {last_uid + 1}:*)'
     )
 
-    if status != "OK" or not messages[0]:
-        print("[Gmail] No emails found today")
+    uids = []
+    if status == "OK" and messages[0]:
+        # "N:*" always matches the highest UID, even when it is below N
+        uids = [u for u in messages[0].split() if int(u) > last_uid]
+    if not uids:
+        print("[Gmail] No new emails today")
         mail.logout()
-        return [], set()
-
-    email_ids = messages[0].split()
-    print(f"[Gmail] Found {len(email_ids)} emails today")
+        return [], set(), cursor
 
-    results = []
-    new_ids = set()
-    for eid in email_ids:
-        status, data = mail.fetch(eid, "(RFC822)")
-        if status != "OK":
-            continue
+    print(f"[Gmail] Found {len(uids)} new emails today")
 
-        msg = email.message_from_bytes(data[0][1])
-        msg_id = msg.get("Message-ID", eid.decode())
+    # Pass 1: one pipelined FETCH of headers + MIME tree for all messages.
+    # BODY.PEEK leaves the \Seen flag untouched.
+    status, data = mail.uid("FETCH", b",".join(uids), "(BODY.PEEK[HEADER] BODYSTRUCTURE)")
+    if status != "OK":
+        print("[Gmail] FETCH failed")
+        mail.logout()
+        return [], set(), cursor
+
+    candidates = []             # (uid, subject, msg_id, [(part_number, filename, part)])
+    wanted = defaultdict(list)  # part_number → uids that have an Excel part there
+    fetched = _parse_fetch(data)
+    for uid in sorted(fetched):
+        item = fetched[uid]
+        cursor["last_uid"] = max(cursor["last_uid"], uid)
+        msg = _HEADER_PARSER.parsebytes(item.get(b"BODY[HEADER]") or b"")
+        msg_id = str(msg.get("Message-ID", uid))
         if msg_id in processed:
             print(f"[Gmail] Skip (already sent): {msg_id}")
             continue
 
-        subject = decode_header_value(msg["Subject"])
-        files = []
+        structure = item.get(b"BODYSTRUCTURE")
+        if not isinstance(structure, list) or not structure:
+            continue
 
-        for part in msg.walk():
-            filename = part.get_filename()
-            if not filename:
+        parts = []
+        for number, leaf in _iter_parts(structure):
+            # Body text/html parts have no name: skip header rebuilding for them
+            if not _has_filename(leaf):
                 continue
-            decoded_name = decode_header_value(filename)
-            if decoded_name.endswith((".xlsx", ".xls", ".csv")):
-                safe_name = decoded_name.replace("/", "_").replace("\\", "_")
-                filepath = os.path.join(DOWNLOAD_DIR, safe_name)
-                with open(filepath, "wb") as f:
-                    f.write(part.get_payload(decode=True))
-                files.append(filepath)
+            part = _part_headers(leaf)
+            filename = part.get_filename()
+            if filename and filename.lower().endswith(EXCEL_EXTENSIONS):
+                parts.append((number, filename, part))
+                wanted[number].append(uid)
+
+        if parts:
+            candidates.append((uid, str(msg["Subject"] or ""), msg_id, parts))
+
+    # Pass 2: one FETCH per distinct part number (auto.ru mails share a layout)
+    bodies = {}
+    for number, part_uids in wanted.items():
+        uid_set = b",".join(str(u).encode() for u in part_uids)
+        status, data = mail.uid("FETCH", uid_set, f"(BODY.PEEK[{number}])")
+        if status != "OK":
+            print(f"[Gmail] FETCH of part {number} failed")
+            continue
+        key = f"BODY[{number}]".encode()
+        for uid, item in _parse_fetch(data).items():
+            if isinstance(item.get(key), bytes):
+                bodies[uid, number] = item[key]
+    # The last response and item still pin raw literals: drop them so each
+    # body is freed as soon as the loop below pops and decodes it
+    data = item = None
+
+    mail.logout()
+
+    results = []
+    new_ids = set()
+    for uid, subject, msg_id, parts in candidates:
+        if any((uid, number) not in bodies for number, _, _ in parts):
+            # Retry the whole message next run rather than send it half-parsed
+            print(f"[Gmail] Incomplete download, will retry: {msg_id}")
+            cursor["last_uid"] = min(cursor["last_uid"], uid - 1)
+            continue
+
+        files = []
+        for number, filename, part in parts:
+            # Pop the raw literal and drop the encoded copy once decoded, so at
+            # most one attachment is held twice (encoded + decoded) at a time
+            body = bodies.pop((uid, number))
+            part.set_payload(body.decode("ascii", errors="surrogateescape"))
+            del body
+            payload = part.get_payload(decode=True)
+            part.set_payload(None)
+            if KEEP_DOWNLOADS:
+                safe_name = filename.replace("/", "_").replace("\\", "_")
+                with open(os.path.join(DOWNLOAD_DIR, safe_name), "wb") as f:
+                    f.write(payload)
+            files.append((filename, payload))
 
         if files:
             results.append((subject, files))
             new_ids.add(msg_id)
 
-    mail.logout()
-    return results, new_ids
+    return results, new_ids, cursor
 
 
 # ── Excel → ComebackOffer[] ──────────────────────────────────────
 
-def parse_not_purchased(filepath):
-    """Parse 'Не выкупленные' Excel → list[ComebackOffer]."""
-    wb = openpyxl.load_workbook(filepath, read_only=True)
-    offers = []
+def _iter_sheets(source, sheet_predicate):
+    """Yield (sheet_name, headers, rows) for each sheet whose name passes sheet_predicate.
 
-    for sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-        rows = list(ws.iter_rows(values_only=True))
-        if not rows:
-            continue
+    The only place that knows the Excel reader: rows is a lazy iterator of
+    value tuples after the header row. source is a path or a binary file
+    object (e.g. BytesIO of an attachment).
+    """
+    # Imported lazily: openpyxl is slow to import, and runs without new
+    # attachments (the common case) never touch it
+    import openpyxl
 
-        headers = rows[0]
-        data = rows[1:]
-        if not data:
-            continue
+    wb = openpyxl.load_workbook(source, read_only=True)
+    # read_only keeps the zip archive open until close(); release it on errors too
+    try:
+        for sheet_name in wb.sheetnames:
+            # Decide by name first: read_only sheets are only parsed when iterated
+            if not sheet_predicate(sheet_name):
+                continue
 
-        if "совпадения" in sheet_name.lower():
-            i_brand = col_index(headers, "марка")
-            i_model = col_index(headers, "модель")
-            i_salon = col_index(headers, "автосалон")
-            i_link = col_index(headers, "ссылка на объявление")
-
-            seen = set()
-            for row in data:
-                url = extract_url(get(row, i_link) or "")
-                offer_id = extract_offer_id(url)
-                if not offer_id or offer_id in seen:
-                    continue
-                seen.add(offer_id)
-
-                offers.append(ComebackOffer(
-                    offer_id=offer_id,
-                    brand=str(get(row, i_brand) or "").upper(),
-                    model=str(get(row, i_model) or "").upper().replace(" ", "_"),
-                    salon=short_salon(get(row, i_salon)),
-                    category="not_purchased",
-                    mobile_url=make_mobile_link(url),
-                    source="email",
-                ))
-
-    wb.close()
-    return offers
+            # Stream rows; materializing them would defeat read_only mode
+            rows = wb[sheet_name].iter_rows(values_only=True)
+            headers = next(rows, None)
+            if headers:
+                yield sheet_name, headers, rows
+    finally:
+        wb.close()
 
 
-def parse_back_on_sale(filepath):
-    """Parse 'Снова в продаже' Excel → list[ComebackOffer]."""
-    wb = openpyxl.load_workbook(filepath, read_only=True)
+# Offer category → keyword in the names of the sheets that hold it
+SHEET_KEYWORDS = {
+    "not_purchased": "совпадения",
+    "back_on_sale": "найденные",
+}
+
+
+def parse_sheet(source, categories):
+    """Parse offer rows of the given categories → list[ComebackOffer].
+
+    A category's rows live on sheets whose name contains its SHEET_KEYWORDS
+    entry; the workbook is opened once however many categories it holds.
+    """
+    def category_of(sheet_name):
+        name = sheet_name.lower()
+        return next((c for c in categories if SHEET_KEYWORDS[c] in name), None)
+
     offers = []
 
-    for sheet_name in wb.sheetnames:
-        ws = wb[sheet_name]
-        rows = list(ws.iter_rows(values_only=True))
-        if not rows:
-            continue
+    for sheet_name, headers, rows in _iter_sheets(source, category_of):
+        category = category_of(sheet_name)
+        hmap = header_map(headers)
+        i_brand = hmap.get("марка")
+        i_model = hmap.get("модель")
+        i_salon = hmap.get("автосалон")
+        i_link = hmap.get("ссылка на объявление")
+        if i_link is None:
+            continue  # no link column → no offer ids on this sheet
+
+        # Pad short rows once so the per-field reads below are plain indexing
+        width = max(i for i in (i_brand, i_model, i_salon, i_link) if i is not None) + 1
+
+        seen = set()        # offer ids already taken
+        seen_links = set()  # raw link cells already handled
+        for row in rows:
+            if len(row) < width:
+                row += (None,) * (width - len(row))
+
+            # Duplicate rows repeat the exact cell: skip them before any string work
+            raw_link = row[i_link]
+            if raw_link in seen_links:
+                continue
+            seen_links.add(raw_link)
 
-        headers = rows[0]
-        data = rows[1:]
-        if not data:
-            continue
+            url = extract_url(raw_link or "")
+            offer_id = extract_offer_id(url)
+            if not offer_id or offer_id in seen:
+                continue
+            seen.add(offer_id)
+
+            offers.append(ComebackOffer(
+                offer_id=offer_id,
+                brand=str((row[i_brand] if i_brand is not None else None) or "").upper(),
+                model=normalize_model(row[i_model] if i_model is not None else None),
+                salon=short_salon(row[i_salon] if i_salon is not None else None),
+                category=category,
+                mobile_url=make_mobile_link(url),
+                source="email",
+            ))
 
-        if "найденные" in sheet_name.lower():
-            i_brand = col_index(headers, "марка")
-            i_model = col_index(headers, "модель")
-            i_salon = col_index(headers, "автосалон")
-            i_link = col_index(headers, "ссылка на объявление")
-
-            seen = set()
-            for row in data:
-                url = extract_url(get(row, i_link) or "")
-                offer_id = extract_offer_id(url)
-                if not offer_id or offer_id in seen:
-                    continue
-                seen.add(offer_id)
-
-                offers.append(ComebackOffer(
-                    offer_id=offer_id,
-                    brand=str(get(row, i_brand) or "").upper(),
-                    model=str(get(row, i_model) or "").upper().replace(" ", "_"),
-                    salon=short_salon(get(row, i_salon)),
-                    category="back_on_sale",
-                    mobile_url=make_mobile_link(url),
-                    source="email",
-                ))
-
-    wb.close()
     return offers
 
 
+# 'Не выкупленные' Excel → list[ComebackOffer]
+parse_not_purchased = functools.partial(parse_sheet, categories=("not_purchased",))
+# 'Снова в продаже' Excel → list[ComebackOffer]
+parse_back_on_sale = functools.partial(parse_sheet, categories=("back_on_sale",))
+
+# Attachment filename markers → offer category the report carries
+ATTACHMENT_KINDS = (
+    (("не_выкупленные", "не выкупленные"), "not_purchased"),
+    (("снова_в_продаже", "снова в продаже"), "back_on_sale"),
+)
+
+
+def attachment_categories(filename):
+    """Offer categories an attachment holds, by its (lowercased) filename; () if unknown."""
+    fname = filename.lower()
+    return tuple(
+        category for markers, category in ATTACHMENT_KINDS
+        if any(marker in fname for marker in markers)
+    )
+
+
+def _parse_attachment(categories, payload):
+    """Parse an in-memory attachment (module level so workers can unpickle it)."""
+    return parse_sheet(io.BytesIO(payload), categories)
+
+
+def parse_attachments(jobs):
+    """Parse [(categories, payload)] → list[ComebackOffer], keeping the jobs' order.
+
+    Several large attachments are spread over worker processes; a single
+    file or a small batch is parsed inline.
+    """
+    if not jobs:
+        return []
+    kinds = [categories for categories, _ in jobs]
+    payloads = [payload for _, payload in jobs]
+
+    workers = min(PARSE_MAX_WORKERS, len(jobs))
+    if workers < 2 or sum(map(len, payloads)) < PARSE_POOL_MIN_BYTES:
+        results = map(_parse_attachment, kinds, payloads)
+    else:
+        # spawn, not fork: the API fetch thread is running at this point
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            results = list(pool.map(_parse_attachment, kinds, payloads))
+
+    return [offer for offers in results for offer in offers]
+
+
+# ── HTTP (keep-alive) ────────────────────────────────────────────
+
+# One HTTPS connection per host per thread: API pages and Telegram chunks
+# reuse the TCP+TLS session instead of handshaking on every request
+_HTTP = threading.local()
+
+
+def _post_json(url, payload, headers=None, timeout=10):
+    """POST JSON, return response bytes. HTTP errors raise urllib.error.HTTPError."""
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    # Raw UTF-8: a Cyrillic letter is 2 bytes, its \uXXXX escape would be 6
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    all_headers = {"Content-Type": "application/json", **(headers or {})}
+
+    conns = getattr(_HTTP, "conns", None)
+    if conns is None:
+        conns = _HTTP.conns = {}
+    conn = conns.get(parts.netloc)
+    reused = conn is not None
+    if not reused:
+        conn = conns[parts.netloc] = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+
+    try:
+        conn.request("POST", path, body=data, headers=all_headers)
+        resp = conn.getresponse()
+        body = resp.read()
+    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        conn.close()
+        del conns[parts.netloc]
+        if not reused:
+            raise
+        # Server dropped an idle keep-alive connection — retry on a fresh one
+        return _post_json(url, payload, headers, timeout)
+    except Exception:
+        conn.close()
+        del conns[parts.netloc]
+        raise
+
+    if resp.status >= 400:
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+    return body
+
+
 # ── Auto.ru Comeback API ─────────────────────────────────────────
 
 # Salon ID → short code mapping for API responses
@@ -334,24 +688,28 @@ SALON_ID_SHORT = {
     "chel": "CHL",
     "krd": "KRD",
 }
+_SALON_ID_RE = _key_matcher(SALON_ID_SHORT)
+
+
+@functools.lru_cache(maxsize=1024)
+def api_short_salon(name):
+    """Convert API salon code/name to short code, falling back to short_salon."""
+    if not name:
+        return "???"
+    key = _first_key(_SALON_ID_RE, SALON_ID_SHORT, name.lower())
+    if key:
+        return SALON_ID_SHORT[key]
+    return short_salon(name)
 
 
 def _api_request(body, attempt=1):
     """Single API request. Returns parsed JSON or None."""
-    data = json.dumps(body).encode("utf-8")
-    req = urllib.request.Request(
-        COMEBACK_API_URL,
-        data=data,
-        headers={
-            "Content-Type": "application/json",
-            "x-session-id": VERTIS_SESSION_ID,
-            "X-Authorization": VERTIS_SESSION_ID,
-        },
-        method="POST",
-    )
+    headers = {
+        "x-session-id": VERTIS_SESSION_ID,
+        "X-Authorization": VERTIS_SESSION_ID,
+    }
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            return json.loads(resp.read().decode())
+        return json.loads(_post_json(COMEBACK_API_URL, body, headers, timeout=15).decode())
     except urllib.error.HTTPError as e:
         body_text = ""
         try:
@@ -393,20 +751,12 @@ def _parse_api_offer(item):
     # Brand / model
     car_info = offer.get("car_info", {})
     brand = car_info.get("mark_info", {}).get("name", "").upper()
-    model = car_info.get("model_info", {}).get("name", "").upper().replace(" ", "_")
+    model = normalize_model(car_info.get("model_info", {}).get("name", ""))
 
     # Salon
     salon_info = offer.get("salon", {})
     salon_name = salon_info.get("code", "") or salon_info.get("name", "")
-    salon = "???"
-    if salon_name:
-        sn_lower = salon_name.lower()
-        for key, code in SALON_ID_SHORT.items():
-            if key in sn_lower:
-                salon = code
-                break
-        if salon == "???":
-            salon = short_salon(salon_name)
+    salon = api_short_salon(salon_name)
 
     # Price
     price_info = offer.get("price_info", {})
@@ -471,12 +821,10 @@ def fetch_api_comeback():
 
     print(f"[API] Fetching comeback {yesterday_start.strftime('%d.%m.%Y')} → {today_start.strftime('%d.%m.%Y')}")
 
-    all_offers = []
-    page = 1
     page_size = 50
 
-    while True:
-        body = {
+    def page_body(page):
+        return {
             "filter": {
                 "creation_date_from": str(date_from),
                 "creation_date_to": str(date_to),
@@ -485,7 +833,16 @@ def fetch_api_comeback():
             "page_size": page_size,
         }
 
-        result = _api_request(body)
+    # Page 1 tells total_count; the remaining pages are then fetched concurrently
+    results = [_api_request(page_body(1))]
+    total = (results[0] or {}).get("pagination", {}).get("total_count", 0)
+    num_pages = -(-total // page_size)
+    if num_pages > 1:
+        with ThreadPoolExecutor(max_workers=min(API_MAX_WORKERS, num_pages - 1)) as pool:
+            results += pool.map(_api_request, [page_body(p) for p in range(2, num_pages + 1)])
+
+    all_offers = []
+    for page, result in enumerate(results, 1):
         if not result:
             if page == 1:
                 print("[API] Failed to fetch — continuing with email-only")
@@ -508,7 +865,6 @@ def fetch_api_comeback():
 
         if fetched >= total or len(items) < page_size:
             break
-        page += 1
 
     print(f"[API] Total: {len(all_offers)} offers")
     return all_offers
@@ -552,31 +908,33 @@ SOURCE_ICON = {
 }
 
 
+CATEGORY_TITLES = (
+    ("not_purchased", "🔍 Не выкупленные"),
+    ("back_on_sale", "🔄 Снова в продаже"),
+)
+
+
 def format_offers(offers):
     """Format merged offers into Telegram message text."""
-    not_purchased = [o for o in offers if o.category == "not_purchased"]
-    back_on_sale = [o for o in offers if o.category == "back_on_sale"]
+    # One pass to bucket offers instead of a filtering scan per category
+    by_category = defaultdict(list)
+    for o in offers:
+        by_category[o.category].append(o)
 
     parts = []
 
-    if not_purchased:
-        lines = [f"🔍 Не выкупленные: {len(not_purchased)} авто\n"]
-        for o in not_purchased:
-            icon = SOURCE_ICON.get(o.source, "")
-            extra = _format_extra(o)
-            lines.append(f"{o.offer_id}/")
-            lines.append(f"{o.salon} used {o.brand} {o.model}{extra} {icon}")
-            lines.append(o.mobile_url)
-        parts.append("\n".join(lines))
-
-    if back_on_sale:
-        lines = [f"🔄 Снова в продаже: {len(back_on_sale)} авто\n"]
-        for o in back_on_sale:
-            icon = SOURCE_ICON.get(o.source, "")
-            extra = _format_extra(o)
-            lines.append(f"{o.offer_id}/")
-            lines.append(f"{o.salon} used {o.brand} {o.model}{extra} {icon}")
-            lines.append(o.mobile_url)
+    for category, title in CATEGORY_TITLES:
+        group = by_category.get(category)
+        if not group:
+            continue
+        # One self-contained 3-line record per offer: a single list entry each
+        lines = [f"{title}: {len(group)} авто\n"]
+        lines.extend(
+            f"{o.offer_id}/\n"
+            f"{o.salon} used {o.brand} {o.model}{_format_extra(o)} {SOURCE_ICON.get(o.source, '')}\n"
+            f"{o.mobile_url}"
+            for o in group
+        )
         parts.append("\n".join(lines))
 
     return "\n\n".join(parts)
@@ -599,37 +957,44 @@ def _format_extra(o):
 
 # ── Telegram ─────────────────────────────────────────────────────
 
+def _split_message(text, limit=4000):
+    """Split text into chunks of at most `limit` chars, preferring line breaks.
+
+    Single forward pass over index positions — the text is sliced once per
+    chunk instead of re-copying the whole remainder each time.
+    """
+    chunks = []
+    start, end_of_text = 0, len(text)
+    while end_of_text - start > limit:
+        split_pos = text.rfind("\n", start, start + limit)
+        if split_pos <= start:
+            split_pos = start + limit
+        chunks.append(text[start:split_pos])
+        # Next chunk starts after the break and any leading whitespace
+        start = split_pos
+        while start < end_of_text and text[start].isspace():
+            start += 1
+    chunks.append(text[start:])
+    return chunks
+
+
 def send_telegram(text):
     if not TELEGRAM_CHAT_ID:
         print(text)
         return False
 
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    chunks = []
-    while len(text) > 4000:
-        split_pos = text.rfind("\n", 0, 4000)
-        if split_pos == -1:
-            split_pos = 4000
-        chunks.append(text[:split_pos])
-        text = text[split_pos:].lstrip()
-    chunks.append(text)
-
-    for chunk in chunks:
-        data = json.dumps({
+    # Chunks go out one by one: Telegram must receive them in order
+    for chunk in _split_message(text):
+        payload = {
             "chat_id": TELEGRAM_CHAT_ID,
             "text": chunk,
-        }).encode("utf-8")
-
-        req = urllib.request.Request(
-            url, data=data,
-            headers={"Content-Type": "application/json"},
-        )
+        }
         try:
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                result = json.loads(resp.read().decode())
-                if not result.get("ok"):
-                    print(f"[TG] Error: {result}")
-                    return False
+            result = json.loads(_post_json(url, payload, timeout=10).decode())
+            if not result.get("ok"):
+                print(f"[TG] Error: {result}")
+                return False
         except Exception as e:
             print(f"[TG] Error: {e}")
             return False
@@ -644,30 +1009,40 @@ def run():
 
     state = load_state()
 
-    # 1. Fetch emails → parse Excel → email_offers
-    emails, new_email_ids = fetch_today_emails(state)
-    email_offers = []
-    downloaded_files = []
+    # 1. Start the API fetch in the background — it only waits on apiauto.ru,
+    #    so it overlaps with the Gmail download and Excel parsing below
+    api_pool = ThreadPoolExecutor(max_workers=1)
+    api_future = api_pool.submit(fetch_api_comeback)
+
+    # 2. Fetch emails → parse Excel → email_offers
+    emails, new_email_ids, email_cursor = fetch_today_emails(state)
+    jobs = []
+    parsed = set()  # (categories, digest) of attachments already queued this run
 
     for subject, files in emails:
-        for filepath in files:
-            downloaded_files.append(filepath)
-            fname = os.path.basename(filepath).lower()
+        for filename, payload in files:
+            categories = attachment_categories(filename)
+            if not categories:
+                print(f"[Email] Unknown format: {filename.lower()}")
+                continue
 
-            if "не_выкупленные" in fname or "не выкупленные" in fname:
-                email_offers.extend(parse_not_purchased(filepath))
-            elif "снова_в_продаже" in fname or "снова в продаже" in fname:
-                email_offers.extend(parse_back_on_sale(filepath))
-            else:
-                print(f"[Email] Unknown format: {fname}")
+            # Resent/forwarded reports carry the same file: parse it only once
+            key = (categories, hashlib.blake2b(payload, digest_size=16).digest())
+            if key in parsed:
+                print(f"[Email] Duplicate attachment, skipped: {filename}")
+                continue
+            parsed.add(key)
+            jobs.append((categories, payload))
 
+    email_offers = parse_attachments(jobs)
     print(f"[Email] Parsed {len(email_offers)} offers from email")
 
-    # 2. Fetch API comeback → api_offers
-    api_offers = fetch_api_comeback()
+    # 3. Collect API comeback → api_offers
+    api_offers = api_future.result()
+    api_pool.shutdown()
 
-    # 3. Filter out already-sent API offer_ids
-    sent_api_ids = set(state.get("api_offer_ids", []))
+    # 4. Filter out already-sent API offer_ids
+    sent_api_ids = state["api_offer_ids"]
     if sent_api_ids:
         before = len(api_offers)
         api_offers = [o for o in api_offers if normalize_offer_id(o.offer_id) not in sent_api_ids]
@@ -675,22 +1050,25 @@ def run():
         if skipped:
             print(f"[API] Filtered {skipped} already-sent offers")
 
-    # 4. Merge
+    # 5. Merge
     merged = merge_offers(email_offers, api_offers)
 
     if not merged and not emails:
         print("No new data from email or API.")
+        # Emails without attachments (if any) need no retry
+        state.update(email_cursor)
         save_state(state)
         return
 
     if not merged:
         print("Emails found but no parseable offers.")
         # Still update email IDs so we don't re-process
-        state["email_message_ids"] = list(set(state["email_message_ids"]) | new_email_ids)
+        remember_ids(state["email_message_ids"], new_email_ids)
+        state.update(email_cursor)
         save_state(state)
         return
 
-    # 5. Format
+    # 6. Format
     has_api = any(o.source in ("api", "both") for o in merged)
     source_label = "Email + API" if has_api else "Email"
     header = f"📧 Дайджест auto.ru — {datetime.now().strftime('%d.%m.%Y')} ({source_label})\n"
@@ -698,26 +1076,20 @@ def run():
     body = format_offers(merged)
     message = header + "\n" + body
 
-    # 6. Send
+    # 7. Send
     success = send_telegram(message)
 
-    # 7. Save state
+    # 8. Save state
     if success:
-        state["email_message_ids"] = list(set(state["email_message_ids"]) | new_email_ids)
+        remember_ids(state["email_message_ids"], new_email_ids)
+        state.update(email_cursor)
         new_api_ids = {normalize_offer_id(o.offer_id) for o in api_offers}
-        state["api_offer_ids"] = list(set(state.get("api_offer_ids", [])) | new_api_ids)
+        remember_ids(state["api_offer_ids"], new_api_ids)
         state["api_last_fetch"] = datetime.now().isoformat()
         save_state(state)
 
     print(f"{'✅ Sent' if success else '⚠️ Failed'} — {len(merged)} offers ({source_label})")
 
-    # 8. Cleanup Excel files
-    for f in downloaded_files:
-        try:
-            os.remove(f)
-        except OSError:
-            pass
-
 
 if __name__ == "__main__":
     run()